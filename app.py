@@ -1,13 +1,65 @@
 import streamlit as st
 import plotly.graph_objects as go
+import plotly.io as pio
 import numpy as np
 import json
-from utils.pdf_processor import extract_text_from_pdf
-from utils.keyword_extractor import extract_keywords, calculate_similarity
+import uuid
+from typing import Tuple
+from scipy import sparse
+from utils.pdf_processor import extract_texts_from_pdfs
+from utils.keyword_extractor import build_tfidf_matrix, extract_keywords_from_tfidf, similarity_from_tfidf
 from utils.network_builder import build_network_data, build_paper_detail_network, filter_network_data
 
 st.set_page_config(page_title="論文ネットワーク解析", layout="wide", page_icon="📚")
 
+@st.cache_data(show_spinner=False)
+def analyze_pdfs(datas: Tuple[bytes, ...]):
+    """
+    PDFの内容をキーにテキスト抽出とキーワード抽出の結果をキャッシュする
+    
+    Returns:
+        (TF-IDF行列, 論文ごとのキーワードのリスト)
+    """
+    texts = extract_texts_from_pdfs(datas)
+    
+    # TF-IDF行列を一度だけ構築し、キーワード抽出と類似度計算で共有する
+    tfidf_matrix, feature_names = build_tfidf_matrix(texts)
+    keywords_list = extract_keywords_from_tfidf(tfidf_matrix, feature_names)
+    return tfidf_matrix, keywords_list
+
+def _hash_csr(m: sparse.csr_matrix):
+    """疎行列のハッシュ（値だけでなく非ゼロ要素の位置も含める）"""
+    return (m.shape, m.nnz, hash(m.data.tobytes()), hash(m.indices.tobytes()), hash(m.indptr.tobytes()))
+
+@st.cache_data(hash_funcs={sparse.csr_matrix: _hash_csr})
+def cached_similarity(tfidf_matrix: sparse.csr_matrix):
+    """再実行のたびに類似度行列を再計算しないようにキャッシュする"""
+    return similarity_from_tfidf(tfidf_matrix)
+
+@st.cache_data(show_spinner=False)
+def figure_to_html(fig_json: str) -> str:
+    """図のJSONをキーにHTML出力をキャッシュする"""
+    return pio.from_json(fig_json).to_html(include_plotlyjs='cdn')
+
+@st.cache_data(show_spinner=False)
+def figure_to_png(fig_json: str) -> bytes:
+    """図のJSONをキーにPNG出力をキャッシュする"""
+    return pio.from_json(fig_json).to_image(format="png", width=1200, height=800)
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def cached_filter_network_data(network_key: str, min_similarity: float, max_keywords: int, _network_data):
+    """
+    フィルタ条件が変わらない間はフィルタ結果を再利用する
+    
+    先頭が_の引数はハッシュ対象外のため、解析ごとに発行するnetwork_keyで区別する
+    """
+    return filter_network_data(_network_data, min_similarity=min_similarity, max_keywords=max_keywords)
+
+@st.cache_data(show_spinner=False)
+def cached_paper_detail_network(paper: dict):
+    """論文ごとのキーワードネットワーク（ホバー文字列を含む）を再実行のたびに作り直さない"""
+    return build_paper_detail_network(paper)
+
 # セッション状態の初期化
 if 'papers' not in st.session_state:
     st.session_state.papers = []
@@ -19,6 +71,12 @@ if 'similarity_matrix' not in st.session_state:
     st.session_state.similarity_matrix = None
 if 'network_data' not in st.session_state:
     st.session_state.network_data = None
+if 'tfidf_matrix' not in st.session_state:
+    st.session_state.tfidf_matrix = None
+if 'papers_by_name' not in st.session_state:
+    st.session_state.papers_by_name = {}
+if 'network_key' not in st.session_state:
+    st.session_state.network_key = None
 
 st.title("📚 論文ネットワーク解析システム")
 st.markdown("最大10個の論文をアップロードして、3Dネットワーク図で類似度を可視化します")
@@ -39,19 +97,26 @@ with st.sidebar:
     
     if st.button("解析開始", type="primary", disabled=not uploaded_files):
         with st.spinner("論文を解析中..."):
+            tfidf_matrix, keywords_list = analyze_pdfs(
+                tuple(file.getvalue() for file in uploaded_files)
+            )
+            
             st.session_state.papers = []
-            for idx, file in enumerate(uploaded_files):
-                text = extract_text_from_pdf(file)
-                keywords = extract_keywords(text)
+            for idx, (file, keywords) in enumerate(zip(uploaded_files, keywords_list)):
                 st.session_state.papers.append({
                     'id': idx,
                     'name': file.name,
-                    'text': text,
                     'keywords': keywords
                 })
+            st.session_state.papers_by_name = {p['name']: p for p in reversed(st.session_state.papers)}
+            st.session_state.tfidf_matrix = tfidf_matrix
             st.session_state.selected_paper_ids = [p['id'] for p in st.session_state.papers]
-            st.session_state.similarity_matrix = calculate_similarity(st.session_state.papers)
-            st.session_state.network_data = build_network_data(st.session_state.papers)
+            st.session_state.similarity_matrix = cached_similarity(tfidf_matrix)
+            st.session_state.network_data = build_network_data(
+                st.session_state.papers,
+                similarity_matrix=st.session_state.similarity_matrix
+            )
+            st.session_state.network_key = uuid.uuid4().hex
             st.success(f"✅ {len(uploaded_files)}個の論文を解析しました")
     
     if st.session_state.papers:
@@ -108,22 +173,20 @@ else:
         
         st.divider()
         
-        network_data = filter_network_data(
-            st.session_state.network_data,
-            st.session_state.papers,
-            min_similarity=min_similarity,
-            max_keywords=max_keywords
+        network_data = cached_filter_network_data(
+            st.session_state.network_key,
+            min_similarity,
+            max_keywords,
+            st.session_state.network_data
         )
         
         selected_ids = set(st.session_state.selected_paper_ids)
         
         # 論文ノードの色と透明度を調整
-        paper_colors = []
-        for paper_id in network_data['paper_ids']:
-            if paper_id in selected_ids:
-                paper_colors.append('rgba(59, 130, 246, 1.0)')
-            else:
-                paper_colors.append('rgba(148, 163, 184, 0.2)')
+        paper_colors = [
+            'rgba(59, 130, 246, 1.0)' if paper_id in selected_ids else 'rgba(148, 163, 184, 0.2)'
+            for paper_id in network_data['paper_ids']
+        ]
         
         if network_data['keyword_labels']:
             with st.expander("🔍 キーワードでフィルタリング（オプション）"):
@@ -135,11 +198,14 @@ else:
                 )
                 
                 if selected_keywords:
-                    keyword_indices = [i for i, kw in enumerate(network_data['keyword_labels']) if kw in selected_keywords]
-                    network_data['keyword_x'] = [network_data['keyword_x'][i] for i in keyword_indices]
-                    network_data['keyword_y'] = [network_data['keyword_y'][i] for i in keyword_indices]
-                    network_data['keyword_z'] = [network_data['keyword_z'][i] for i in keyword_indices]
-                    network_data['keyword_labels'] = [network_data['keyword_labels'][i] for i in keyword_indices]
+                    selected_set = set(selected_keywords)
+                    labels = network_data['keyword_labels']
+                    keyword_indices = np.fromiter(
+                        (i for i, kw in enumerate(labels) if kw in selected_set), dtype=np.int64
+                    )
+                    for key in ('keyword_x', 'keyword_y', 'keyword_z'):
+                        network_data[key] = np.asarray(network_data[key])[keyword_indices]
+                    network_data['keyword_labels'] = [labels[i] for i in keyword_indices]
                     network_data['keyword_hover'] = [network_data['keyword_hover'][i] for i in keyword_indices]
         
         # 3D可視化
@@ -235,41 +301,44 @@ else:
         st.markdown("### 📥 エクスポート")
         col1, col2, col3 = st.columns(3)
         
+        # HTML/PNGの生成は重いため、ボタンが押されたときだけ行う
         with col1:
-            html_str = fig.to_html(include_plotlyjs='cdn')
-            st.download_button(
-                label="📄 HTMLとしてダウンロード",
-                data=html_str,
-                file_name="network_visualization.html",
-                mime="text/html",
-                help="インタラクティブな3D可視化をHTMLファイルとして保存"
-            )
-        
-        with col2:
-            try:
-                img_bytes = fig.to_image(format="png", width=1200, height=800)
+            if st.button("📄 HTMLを生成", help="インタラクティブな3D可視化をHTMLファイルとして保存"):
+                html_str = figure_to_html(fig.to_json())
                 st.download_button(
-                    label="🖼️ PNGとしてダウンロード",
-                    data=img_bytes,
-                    file_name="network_visualization.png",
-                    mime="image/png",
-                    help="静的画像として保存"
+                    label="📄 HTMLとしてダウンロード",
+                    data=html_str,
+                    file_name="network_visualization.html",
+                    mime="text/html",
+                    help="インタラクティブな3D可視化をHTMLファイルとして保存"
                 )
-            except:
-                st.info("PNG出力には追加のライブラリが必要です")
+        
+        with col2:
+            if st.button("🖼️ PNGを生成", help="静的画像として保存"):
+                try:
+                    img_bytes = figure_to_png(fig.to_json())
+                    st.download_button(
+                        label="🖼️ PNGとしてダウンロード",
+                        data=img_bytes,
+                        file_name="network_visualization.png",
+                        mime="image/png",
+                        help="静的画像として保存"
+                    )
+                except:
+                    st.info("PNG出力には追加のライブラリが必要です")
         
         with col3:
             export_data = {
                 'papers': [{'id': p['id'], 'name': p['name'], 'keywords': p['keywords'][:10]} for p in st.session_state.papers],
                 'network_data': {
                     'nodes': {
-                        'papers': [{'id': i, 'label': label, 'position': [x, y, z]} 
+                        'papers': [{'id': i, 'label': label, 'position': [float(x), float(y), float(z)]} 
                                   for i, label, x, y, z in zip(network_data['paper_ids'], 
                                                                 network_data['paper_labels'],
                                                                 network_data['paper_x'],
                                                                 network_data['paper_y'],
                                                                 network_data['paper_z'])],
-                        'keywords': [{'label': label, 'position': [x, y, z]} 
+                        'keywords': [{'label': label, 'position': [float(x), float(y), float(z)]} 
                                     for label, x, y, z in zip(network_data['keyword_labels'],
                                                               network_data['keyword_x'],
                                                               network_data['keyword_y'],
@@ -298,9 +367,7 @@ else:
             )
         with col2:
             if st.button("詳細表示", type="primary"):
-                st.session_state.selected_paper = next(
-                    p for p in st.session_state.papers if p['name'] == selected_paper_name
-                )
+                st.session_state.selected_paper = st.session_state.papers_by_name[selected_paper_name]
                 st.rerun()
     
     with tab2:
@@ -310,7 +377,7 @@ else:
             
             # 論文内キーワードネットワーク
             st.markdown("### キーワード関係図")
-            detail_network = build_paper_detail_network(paper)
+            detail_network = cached_paper_detail_network(paper)
             
             fig_detail = go.Figure(data=[
                 # エッジ
@@ -386,20 +453,18 @@ else:
             col1, col2, col3, col4 = st.columns(4)
             
             # 上三角行列の値のみを取得（対角線を除く）
-            upper_triangle = []
-            for i in range(n_papers):
-                for j in range(i + 1, n_papers):
-                    upper_triangle.append(similarity_matrix[i][j])
+            upper_i, upper_j = np.triu_indices(n_papers, k=1)
+            upper_triangle = similarity_matrix[upper_i, upper_j]
             
-            if upper_triangle:
+            if upper_triangle.size:
                 with col1:
-                    st.metric("平均類似度", f"{np.mean(upper_triangle):.3f}")
+                    st.metric("平均類似度", f"{upper_triangle.mean():.3f}")
                 with col2:
-                    st.metric("最大類似度", f"{np.max(upper_triangle):.3f}")
+                    st.metric("最大類似度", f"{upper_triangle.max():.3f}")
                 with col3:
-                    st.metric("最小類似度", f"{np.min(upper_triangle):.3f}")
+                    st.metric("最小類似度", f"{upper_triangle.min():.3f}")
                 with col4:
-                    st.metric("標準偏差", f"{np.std(upper_triangle):.3f}")
+                    st.metric("標準偏差", f"{upper_triangle.std():.3f}")
             
             st.divider()
             
@@ -412,7 +477,8 @@ else:
                 x=paper_names,
                 y=paper_names,
                 colorscale='RdYlGn',
-                text=np.round(similarity_matrix, 3),
+                # float32のままだと丸めても0.12300000339746475のように表示されるため、倍精度に戻してから丸める
+                text=np.round(similarity_matrix.astype(np.float64), 3),
                 texttemplate='%{text}',
                 textfont={"size": 10},
                 colorbar=dict(title="類似度"),
@@ -434,21 +500,14 @@ else:
             
             st.markdown("### 📋 論文ペアの詳細類似度")
             
-            # 類似度の高い順にソート
-            paper_pairs = []
-            for i in range(n_papers):
-                for j in range(i + 1, n_papers):
-                    paper_pairs.append({
-                        '論文1': st.session_state.papers[i]['name'],
-                        '論文2': st.session_state.papers[j]['name'],
-                        '類似度': similarity_matrix[i][j]
-                    })
-            
-            paper_pairs.sort(key=lambda x: x['類似度'], reverse=True)
-            
-            # データフレームとして表示
+            # データフレームとして表示（類似度の高い順にソート）
             import pandas as pd
-            df = pd.DataFrame(paper_pairs)
+            names = [p['name'] for p in st.session_state.papers]
+            df = pd.DataFrame({
+                '論文1': [names[i] for i in upper_i],
+                '論文2': [names[j] for j in upper_j],
+                '類似度': upper_triangle
+            }).sort_values('類似度', ascending=False, kind='stable', ignore_index=True)
             
             # 類似度でフィルタリング
             min_sim_filter = st.slider(
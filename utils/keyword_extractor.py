@@ -1,12 +1,13 @@
 import re
 from collections import Counter
-from typing import List, Tuple, Dict
+from typing import List, Tuple
 import numpy as np
+from scipy import sparse
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.preprocessing import normalize
 
 # 英語のストップワード（基本的なもの）
-STOP_WORDS = set([
+STOP_WORDS = frozenset([
     'the', 'a', 'an', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for',
     'of', 'with', 'by', 'from', 'as', 'is', 'was', 'are', 'were', 'been',
     'be', 'have', 'has', 'had', 'do', 'does', 'did', 'will', 'would', 'could',
@@ -14,59 +15,120 @@ STOP_WORDS = set([
     'its', 'we', 'our', 'you', 'your', 'they', 'their', 'i', 'my', 'me'
 ])
 
+# 4文字以上の英字の並びを単語とみなすパターン（モジュール読み込み時に一度だけコンパイル）
+_WORD = re.compile(r'[a-z]{4,}')
+
 def extract_keywords(text: str, top_n: int = 30) -> List[Tuple[str, float]]:
     """
-    テキストからキーワードを抽出（TF-IDFベース）
+    テキストからキーワードを抽出（単語の出現頻度ベース）
+    
+    1つのテキストだけで完結する頻度集計で、スコアは最頻出語を1.0とした相対頻度。
+    複数論文を解析する場合はbuild_tfidf_matrixとextract_keywords_from_tfidfを使う。
     
     Args:
         text: 入力テキスト
         top_n: 抽出するキーワード数
         
     Returns:
-        (キーワード, スコア)のリスト
+        (キーワード, スコア)のリスト（頻度の降順、同点は先に出現した順）
     """
-    # テキストの前処理
-    text = text.lower()
-    text = re.sub(r'[^a-z\s]', ' ', text)
-    words = text.split()
+    # 単語の切り出しと短い単語の除去を正規表現エンジン内で一度に行う
+    words = _WORD.findall(text.lower())
     
-    # ストップワードと短い単語を除去
-    words = [w for w in words if w not in STOP_WORDS and len(w) > 3]
+    # ストップワードを除去しながら出現頻度を計算
+    word_freq = Counter(w for w in words if w not in STOP_WORDS)
     
-    if not words:
+    if not word_freq or top_n <= 0:
         return []
     
-    # 単語の出現頻度を計算
-    word_freq = Counter(words)
+    # 上位top_n件のしきい値を部分選択で求め、しきい値以上の候補だけをソート（全語彙のソートを避ける）
+    items = list(word_freq.items())
+    freqs = np.fromiter((freq for _, freq in items), dtype=np.int64, count=len(items))
+    k = min(top_n, len(items))
+    threshold = -np.partition(-freqs, k - 1)[k - 1]
+    candidates = np.flatnonzero(freqs >= threshold)
+    
+    # 頻度の降順、同点は先に出現した順（Counter.most_commonと同じ順序）
+    top_idx = candidates[np.lexsort((candidates, -freqs[candidates]))][:k]
     
     # 正規化されたスコアを計算
-    max_freq = max(word_freq.values())
-    keywords = [(word, freq / max_freq) for word, freq in word_freq.most_common(top_n)]
+    max_freq = freqs[top_idx[0]]
+    keywords = [(items[i][0], float(freqs[i] / max_freq)) for i in top_idx]
     
     return keywords
 
-def calculate_similarity(papers: List[Dict]) -> np.ndarray:
+def build_tfidf_matrix(texts: List[str]) -> Tuple[sparse.csr_matrix, np.ndarray]:
     """
-    論文間の類似度を計算
+    全論文のテキストから一度にTF-IDF行列を構築
     
     Args:
-        papers: 論文データのリスト
+        texts: 論文テキストのリスト
         
     Returns:
-        類似度行列
+        (TF-IDF行列, 語彙の配列)
     """
-    if len(papers) < 2:
-        return np.array([[1.0]])
-    
-    # TF-IDFベクトル化
-    texts = [paper['text'] for paper in papers]
-    vectorizer = TfidfVectorizer(max_features=100, stop_words='english')
+    # 語彙数を制限すると類似度の精度が落ちるため上限は設けない（疎行列の計算量はnnzに比例する）
+    vectorizer = TfidfVectorizer(stop_words='english', token_pattern=r'[a-z]{4,}', dtype=np.float32)
     
     try:
         tfidf_matrix = vectorizer.fit_transform(texts)
-        similarity_matrix = cosine_similarity(tfidf_matrix)
-        return similarity_matrix
-    except:
-        # エラー時はランダムな類似度を返す
-        n = len(papers)
-        return np.random.rand(n, n) * 0.5 + 0.3
+    except ValueError:
+        # 有効な単語が一つもない場合
+        return sparse.csr_matrix((len(texts), 0), dtype=np.float32), np.array([], dtype=object)
+    
+    return tfidf_matrix, vectorizer.get_feature_names_out()
+
+def extract_keywords_from_tfidf(tfidf_matrix: sparse.csr_matrix, feature_names: np.ndarray, top_n: int = 30) -> List[List[Tuple[str, float]]]:
+    """
+    TF-IDF行列の各行から論文ごとのキーワードを抽出
+    
+    Args:
+        tfidf_matrix: build_tfidf_matrixで構築したTF-IDF行列
+        feature_names: 語彙の配列
+        top_n: 抽出するキーワード数
+        
+    Returns:
+        論文ごとの(キーワード, スコア)のリスト
+    """
+    keywords_list = []
+    for i in range(tfidf_matrix.shape[0]):
+        row = tfidf_matrix.getrow(i)
+        if row.nnz == 0 or top_n <= 0:
+            keywords_list.append([])
+            continue
+        
+        # 上位top_n件のみを部分選択してからソート（同点は語彙順で固定する）
+        k = min(top_n, row.nnz)
+        idx = np.argpartition(-row.data, k - 1)[:k]
+        idx = idx[np.lexsort((idx, -row.data[idx]))]
+        
+        # 最大値が1.0になるように正規化
+        max_score = row.data[idx[0]]
+        keywords_list.append([
+            (str(feature_names[row.indices[j]]), float(row.data[j] / max_score)) for j in idx
+        ])
+    
+    return keywords_list
+
+def similarity_from_tfidf(tfidf_matrix: sparse.csr_matrix) -> np.ndarray:
+    """
+    TF-IDF行列からコサイン類似度行列を計算
+    
+    Args:
+        tfidf_matrix: TF-IDF行列
+        
+    Returns:
+        類似度行列
+    """
+    if tfidf_matrix.shape[0] < 2:
+        return np.array([[1.0]], dtype=np.float32)
+    
+    # 有効な単語が一つもない場合（画像のみのPDFや英単語を含まない論文）は自分自身とのみ類似とする
+    if tfidf_matrix.shape[1] == 0:
+        return np.eye(tfidf_matrix.shape[0], dtype=np.float32)
+    
+    # 行を一度だけL2正規化すれば、内積がそのままコサイン類似度になる
+    normalized = normalize(tfidf_matrix, norm='l2', axis=1)
+    
+    # 可視化用途には単精度で十分なため、float32で保持してメモリを半減させる
+    return np.asarray((normalized @ normalized.T).toarray(), dtype=np.float32)
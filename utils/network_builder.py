@@ -1,14 +1,19 @@
+from functools import lru_cache
 import numpy as np
-from typing import Dict, List
+from typing import Dict, List, Tuple
 from collections import Counter
-from utils.keyword_extractor import calculate_similarity
 
-def build_network_data(papers: List[Dict]) -> Dict:
+# ホバー表示のテンプレート（ノードごとに%で埋める）
+_PAPER_HOVER = "<b>%s</b><br>キーワード数: %d"
+_KEYWORD_HOVER = "<b>%s</b><br>出現回数: %.2f"
+
+def build_network_data(papers: List[Dict], similarity_matrix: np.ndarray) -> Dict:
     """
     全体ネットワークのデータを構築（球体レイアウト）
     
     Args:
         papers: 論文データのリスト
+        similarity_matrix: 計算済みの類似度行列（論文の辞書は本文を持たないため、呼び出し側で計算して渡す）
         
     Returns:
         3D可視化用のデータ辞書
@@ -18,121 +23,83 @@ def build_network_data(papers: List[Dict]) -> Dict:
     
     n_papers = len(papers)
     
-    paper_positions = {}
-    radius_outer = 3.0
-    
-    golden_angle = np.pi * (3.0 - np.sqrt(5.0))  # ゴールデンアングル
-    
-    for i in range(n_papers):
-        y = 1 - (i / float(n_papers - 1 if n_papers > 1 else 1)) * 2
-        radius = np.sqrt(1 - y * y)
-        theta = golden_angle * i
-        
-        x = radius_outer * np.cos(theta) * radius
-        z = radius_outer * np.sin(theta) * radius
-        y = radius_outer * y
-        
-        paper_positions[i] = (x, y, z)
+    paper_positions = _layout_paper_positions(n_papers)
     
-    # 全論文からキーワードを収集
-    all_keywords = Counter()
-    for paper in papers:
-        if 'keywords' in paper and paper['keywords']:
-            for keyword, score in paper['keywords'][:20]:
-                if isinstance(keyword, str) and isinstance(score, (int, float)):
-                    all_keywords[keyword] += score
+    # 全論文からキーワードを収集し、キーワードごとのスコア合計をまとめて集計
+    # （keywordsはkeyword_extractorが返す(str, float)のリストなので型チェックはしない）
+    pairs = [
+        pair
+        for paper in papers if paper.get('keywords')
+        for pair in paper['keywords'][:20]
+    ]
     
-    if not all_keywords:
+    if not pairs:
         print("[v0] No keywords found in papers")
         return _empty_network_data()
     
-    top_keywords = [kw for kw, _ in all_keywords.most_common(30)]
+    keywords, scores = zip(*pairs)
+    unique_keywords, first_index, inverse = np.unique(np.array(keywords), return_index=True, return_inverse=True)
+    totals = np.bincount(inverse, weights=np.array(scores, dtype=float))
+    all_keywords = Counter(dict(zip(unique_keywords.tolist(), totals.tolist())))
+    
+    # 上位30件のしきい値をO(V)の部分選択で求め、しきい値以上の候補だけを並べ替える
+    # NaNのスコアはしきい値を壊すため最下位として扱う
+    ranked = np.where(np.isnan(totals), -np.inf, totals)
+    k = min(30, len(ranked))
+    threshold = -np.partition(-ranked, k - 1)[k - 1]
+    candidates = np.flatnonzero(ranked >= threshold)
+    
+    # スコアの降順、同点は先に出現した順（Counter.most_commonと同じ順序）
+    order = candidates[np.lexsort((first_index[candidates], -ranked[candidates]))][:k]
+    top_keywords = unique_keywords[order].tolist()
     
     if not top_keywords:
         print("[v0] No top keywords found")
         return _empty_network_data()
     
-    keyword_positions = {}
-    radius_inner = 1.5
-    n_keywords = len(top_keywords)
+    keyword_positions = _layout_keyword_positions(len(top_keywords))
+    keyword_index = {kw: i for i, kw in enumerate(top_keywords)}
     
-    for i, kw in enumerate(top_keywords):
-        y = 1 - (i / float(n_keywords - 1 if n_keywords > 1 else 1)) * 2
-        radius = np.sqrt(1 - y * y)
-        theta = golden_angle * i
-        
-        x = radius_inner * np.cos(theta) * radius
-        z = radius_inner * np.sin(theta) * radius
-        y = radius_inner * y
-        
-        keyword_positions[kw] = (x, y, z)
-    
-    # 類似度行列を計算
+    # 類似度行列の検証
     try:
-        similarity_matrix = calculate_similarity(papers)
-        if np.any(np.isnan(similarity_matrix)) or np.any(np.isinf(similarity_matrix)):
-            print("[v0] Warning: similarity matrix contains NaN or Inf values")
+        # NaN/Infは行列全体で一度だけ0に置き換え、以降の判定では個別にチェックしない
+        similarity_matrix = np.nan_to_num(np.asarray(similarity_matrix), nan=0.0, posinf=0.0, neginf=0.0)
+        if similarity_matrix.shape != (n_papers, n_papers):
+            print(f"[v0] Warning: similarity matrix shape {similarity_matrix.shape} does not match {n_papers} papers")
             similarity_matrix = np.eye(n_papers)
     except Exception as e:
-        print(f"[v0] Error calculating similarity: {e}")
+        print(f"[v0] Error reading similarity matrix: {e}")
         similarity_matrix = np.eye(n_papers)
     
-    edge_x, edge_y, edge_z = [], [], []
-    
-    # 論文間のエッジ（類似度が高い場合のみ）
-    for i in range(n_papers):
-        for j in range(i + 1, n_papers):
-            try:
-                similarity = float(similarity_matrix[i][j])
-                if not np.isnan(similarity) and not np.isinf(similarity) and similarity > 0.3:
-                    x0, y0, z0 = paper_positions[i]
-                    x1, y1, z1 = paper_positions[j]
-                    edge_x.extend([x0, x1, None])
-                    edge_y.extend([y0, y1, None])
-                    edge_z.extend([z0, z1, None])
-            except (IndexError, ValueError, TypeError) as e:
-                print(f"[v0] Error processing edge {i}-{j}: {e}")
-                continue
+    # 論文間のエッジ（類似度が高い場合のみ、上三角の値だけを取り出して一度に判定）
+    # 全ペアの類似度は返り値にも保持し、filter_network_dataでは再走査せずマスクだけで絞り込む
+    upper_i, upper_j = np.triu_indices(n_papers, k=1)
+    upper_sim = similarity_matrix[upper_i, upper_j]
+    keep = upper_sim > 0.3
+    edge_x, edge_y, edge_z = _edge_coordinates(paper_positions[upper_i[keep]], paper_positions[upper_j[keep]])
     
     # 論文とキーワード間のエッジ用の別データ
-    keyword_edge_x, keyword_edge_y, keyword_edge_z = [], [], []
-    
-    for i, paper in enumerate(papers):
-        if 'keywords' not in paper or not paper['keywords']:
-            continue
-            
-        paper_keywords = dict(paper['keywords'][:20])
-        x0, y0, z0 = paper_positions[i]
-        
-        for keyword in top_keywords:
-            if keyword in paper_keywords:
-                try:
-                    score = float(paper_keywords[keyword])
-                    if not np.isnan(score) and not np.isinf(score) and score > 0.3:
-                        x1, y1, z1 = keyword_positions[keyword]
-                        keyword_edge_x.extend([x0, x1, None])
-                        keyword_edge_y.extend([y0, y1, None])
-                        keyword_edge_z.extend([z0, z1, None])
-                except (ValueError, TypeError) as e:
-                    print(f"[v0] Error processing keyword edge: {e}")
-                    continue
+    # 行列をしきい値で一括判定（np.nonzeroは論文順・キーワード行順で返す。NaN/Infは除く）
+    keyword_scores = _keyword_score_matrix(papers, keyword_index)
+    pair_papers, pair_keywords = np.nonzero(np.isfinite(keyword_scores))
+    pair_scores = keyword_scores[pair_papers, pair_keywords]
+    keep = pair_scores > 0.3
+    keyword_edge_x, keyword_edge_y, keyword_edge_z = _edge_coordinates(
+        paper_positions[pair_papers[keep]],
+        keyword_positions[pair_keywords[keep]]
+    )
     
     # ノードデータの構築
-    paper_x = [pos[0] for pos in paper_positions.values()]
-    paper_y = [pos[1] for pos in paper_positions.values()]
-    paper_z = [pos[2] for pos in paper_positions.values()]
+    paper_x, paper_y, paper_z = _axis_arrays(paper_positions)
     paper_labels = [f"P{i+1}" for i in range(n_papers)]
-    paper_hover = [
-        f"<b>{p.get('name', 'Unknown')}</b><br>キーワード数: {len(p.get('keywords', []))}" 
-        for p in papers
-    ]
+    paper_names = [p.get('name', 'Unknown') for p in papers]
+    keyword_counts = [len(p.get('keywords', [])) for p in papers]
+    paper_hover = list(map(_PAPER_HOVER.__mod__, zip(paper_names, keyword_counts)))
     paper_ids = list(range(n_papers))
     
-    keyword_x = [pos[0] for pos in keyword_positions.values()]
-    keyword_y = [pos[1] for pos in keyword_positions.values()]
-    keyword_z = [pos[2] for pos in keyword_positions.values()]
+    keyword_x, keyword_y, keyword_z = _axis_arrays(keyword_positions)
     keyword_labels = list(top_keywords)
-    keyword_hover = [f"<b>{kw}</b><br>出現回数: {all_keywords[kw]:.2f}" for kw in top_keywords]
+    keyword_hover = list(map(_KEYWORD_HOVER.__mod__, zip(top_keywords, totals[order].tolist())))
     
     return {
         'edge_x': edge_x,
@@ -155,23 +122,29 @@ def build_network_data(papers: List[Dict]) -> Dict:
         'all_keywords': all_keywords,
         'paper_positions': paper_positions,
         'keyword_positions': keyword_positions,
-        'similarity_matrix': similarity_matrix
+        'keyword_index': keyword_index,
+        # filter_network_data用の候補エッジ（論文ペアと論文×キーワードの組、スコア付き）
+        '_edge_i': upper_i,
+        '_edge_j': upper_j,
+        '_edge_sim': upper_sim,
+        '_keyword_edge_papers': pair_papers,
+        '_keyword_edge_keywords': pair_keywords,
+        '_keyword_edge_scores': pair_scores
     }
 
-def filter_network_data(network_data: Dict, papers: List[Dict], min_similarity: float = 0.3, max_keywords: int = 25) -> Dict:
+def filter_network_data(network_data: Dict, min_similarity: float = 0.3, max_keywords: int = 25) -> Dict:
     """
     ネットワークデータをフィルタリング
     
     Args:
         network_data: 元のネットワークデータ
-        papers: 論文データのリスト
         min_similarity: 最小類似度閾値
         max_keywords: 表示する最大キーワード数
         
     Returns:
         フィルタリングされたネットワークデータ
     """
-    if not network_data or 'similarity_matrix' not in network_data:
+    if not network_data or '_edge_sim' not in network_data:
         return network_data
     
     filtered_data = network_data.copy()
@@ -184,72 +157,168 @@ def filter_network_data(network_data: Dict, papers: List[Dict], min_similarity:
         filtered_data['keyword_labels'] = network_data['keyword_labels'][:max_keywords]
         filtered_data['keyword_hover'] = network_data['keyword_hover'][:max_keywords]
     
-    # 類似度でエッジをフィルタリング
-    similarity_matrix = network_data['similarity_matrix']
+    # 類似度でエッジをフィルタリング（build_network_dataで保持した候補をマスクするだけ）
     paper_positions = network_data['paper_positions']
-    n_papers = len(papers)
-    
-    edge_x, edge_y, edge_z = [], [], []
-    for i in range(n_papers):
-        for j in range(i + 1, n_papers):
-            try:
-                similarity = float(similarity_matrix[i][j])
-                if not np.isnan(similarity) and not np.isinf(similarity) and similarity > min_similarity:
-                    x0, y0, z0 = paper_positions[i]
-                    x1, y1, z1 = paper_positions[j]
-                    edge_x.extend([x0, x1, None])
-                    edge_y.extend([y0, y1, None])
-                    edge_z.extend([z0, z1, None])
-            except (IndexError, ValueError, TypeError):
-                continue
-    
+    keep = network_data['_edge_sim'] > min_similarity
+    edge_x, edge_y, edge_z = _edge_coordinates(
+        paper_positions[network_data['_edge_i'][keep]],
+        paper_positions[network_data['_edge_j'][keep]]
+    )
     filtered_data['edge_x'] = edge_x
     filtered_data['edge_y'] = edge_y
     filtered_data['edge_z'] = edge_z
     
-    # キーワードエッジもフィルタリング
-    keyword_edge_x, keyword_edge_y, keyword_edge_z = [], [], []
+    # キーワードエッジもフィルタリング（表示中の上位キーワードの行だけを残す）
     keyword_positions = network_data['keyword_positions']
-    top_keywords = filtered_data['keyword_labels']
+    keyword_edge_keywords = network_data['_keyword_edge_keywords']
+    keep = (
+        (network_data['_keyword_edge_scores'] > min_similarity)
+        & (keyword_edge_keywords < len(filtered_data['keyword_labels']))
+    )
+    keyword_edge_x, keyword_edge_y, keyword_edge_z = _edge_coordinates(
+        paper_positions[network_data['_keyword_edge_papers'][keep]],
+        keyword_positions[keyword_edge_keywords[keep]]
+    )
+    filtered_data['keyword_edge_x'] = keyword_edge_x
+    filtered_data['keyword_edge_y'] = keyword_edge_y
+    filtered_data['keyword_edge_z'] = keyword_edge_z
+    
+    return filtered_data
+
+def _keyword_score_matrix(papers: List[Dict], keyword_index: Dict[str, int]) -> np.ndarray:
+    """
+    論文×表示キーワードのスコア行列を作成
+    
+    各論文は自分の上位20キーワードだけを走査し、keyword_indexとの照合は辞書引き1回で済ませる
+    
+    Args:
+        papers: 論文データのリスト
+        keyword_index: 表示キーワードから列番号への辞書
+        
+    Returns:
+        (論文数, キーワード数) の配列（該当なしはNaN）
+    """
+    scores = np.full((len(papers), len(keyword_index)), np.nan)
     
     for i, paper in enumerate(papers):
         if 'keywords' not in paper or not paper['keywords']:
             continue
-            
-        paper_keywords = dict(paper['keywords'][:20])
-        x0, y0, z0 = paper_positions[i]
         
-        for keyword in top_keywords:
-            if keyword in paper_keywords and keyword in keyword_positions:
-                try:
-                    score = float(paper_keywords[keyword])
-                    if not np.isnan(score) and not np.isinf(score) and score > min_similarity:
-                        x1, y1, z1 = keyword_positions[keyword]
-                        keyword_edge_x.extend([x0, x1, None])
-                        keyword_edge_y.extend([y0, y1, None])
-                        keyword_edge_z.extend([z0, z1, None])
-                except (ValueError, TypeError):
-                    continue
+        # スコアはkeyword_extractorが返すfloatなのでそのまま代入する
+        for keyword, score in dict(paper['keywords'][:20]).items():
+            j = keyword_index.get(keyword)
+            if j is not None:
+                scores[i, j] = score
     
-    filtered_data['keyword_edge_x'] = keyword_edge_x
-    filtered_data['keyword_edge_y'] = keyword_edge_y
-    filtered_data['keyword_edge_z'] = keyword_edge_z
+    return scores
+
+def _layout_paper_positions(n_papers: int) -> np.ndarray:
+    """論文ノードを外側の球面に配置"""
+    return _sphere_positions(n_papers, 3.0)
+
+def _layout_keyword_positions(n_keywords: int) -> np.ndarray:
+    """キーワードノードを内側の球面に配置"""
+    return _sphere_positions(n_keywords, 1.5)
+
+@lru_cache(maxsize=64)
+def _sphere_positions(n: int, radius: float) -> np.ndarray:
+    """
+    ゴールデンアングルを用いて球面上にn個の点を均等に配置
     
-    return filtered_data
+    配置はnとradiusだけで決まるためメモ化し、同じ論文数での再描画では再計算しない。
+    キャッシュした配列を共有するので読み取り専用で返す。
+    
+    Args:
+        n: 点の数
+        radius: 球の半径
+        
+    Returns:
+        (n, 3) のfloat32座標配列（読み取り専用）
+    """
+    # 2点以下は極（y = ±radius）に置くだけなので三角関数を計算しない
+    if n <= 2:
+        positions = np.array([[0.0, radius, 0.0], [0.0, -radius, 0.0]][:n], dtype=np.float32).reshape(n, 3)
+        positions.flags.writeable = False
+        return positions
+    
+    golden_angle = np.pi * (3.0 - np.sqrt(5.0))  # ゴールデンアングル
+    
+    i = np.arange(n)
+    y = 1 - (i / float(n - 1)) * 2
+    r = np.sqrt(1 - y * y)
+    theta = golden_angle * i
+    
+    # ブラウザ側はfloat32で描画するため、配置の時点で単精度の1つのバッファにまとめる
+    positions = np.empty((n, 3), dtype=np.float32)
+    positions[:, 0] = radius * np.cos(theta) * r
+    positions[:, 1] = radius * y
+    positions[:, 2] = radius * np.sin(theta) * r
+    positions.flags.writeable = False
+    return positions
+
+def _axis_arrays(positions) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    座標の列を軸ごとのfloat32配列に変換
+    
+    3軸分を1つの連続バッファ (3, n) にまとめ、各軸はその行のビューとして返す
+    
+    Args:
+        positions: (n, 3) の座標配列、または (x, y, z) の列
+        
+    Returns:
+        (x, y, z) のfloat32配列
+    """
+    xyz = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    x, y, z = np.ascontiguousarray(xyz.T)
+    return x, y, z
+
+def _edge_coordinates(starts, ends) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    エッジの始点・終点からPlotly用の座標配列を構築
+    
+    各エッジは (始点, 終点, NaN) の3要素で表し、NaNで線を区切る
+    
+    Args:
+        starts: 始点座標の列（要素は (x, y, z)）
+        ends: 終点座標の列（要素は (x, y, z)）
+        
+    Returns:
+        (edge_x, edge_y, edge_z) のfloat32配列
+    """
+    starts = np.asarray(starts, dtype=np.float32).reshape(-1, 3)
+    ends = np.asarray(ends, dtype=np.float32).reshape(-1, 3)
+    
+    # 3軸分を1つのバッファ (軸, エッジ, [始点, 終点, NaN]) に書き込み、各軸は行のビューとして返す
+    coords = np.empty((3, len(starts), 3), dtype=np.float32)
+    coords[:, :, 0] = starts.T
+    coords[:, :, 1] = ends.T
+    coords[:, :, 2] = np.nan
+    
+    edge_x, edge_y, edge_z = coords.reshape(3, -1)
+    return edge_x, edge_y, edge_z
 
 def _empty_network_data() -> Dict:
     """空のネットワークデータを返す"""
+    # 複数のキーで共有するため、どれか1つへの書き込みが他に波及しないよう読み取り専用にする
+    empty = np.empty(0, dtype=np.float32)
+    empty.flags.writeable = False
     return {
-        'edge_x': [], 'edge_y': [], 'edge_z': [],
-        'keyword_edge_x': [], 'keyword_edge_y': [], 'keyword_edge_z': [],
-        'paper_x': [], 'paper_y': [], 'paper_z': [],
+        'edge_x': empty, 'edge_y': empty, 'edge_z': empty,
+        'keyword_edge_x': empty, 'keyword_edge_y': empty, 'keyword_edge_z': empty,
+        'paper_x': empty, 'paper_y': empty, 'paper_z': empty,
         'paper_labels': [], 'paper_hover': [], 'paper_ids': [],
-        'keyword_x': [], 'keyword_y': [], 'keyword_z': [],
+        'keyword_x': empty, 'keyword_y': empty, 'keyword_z': empty,
         'keyword_labels': [], 'keyword_hover': [],
         'all_keywords': Counter(),
-        'paper_positions': {},
-        'keyword_positions': {},
-        'similarity_matrix': np.array([])
+        'paper_positions': np.empty((0, 3), dtype=np.float32),
+        'keyword_positions': np.empty((0, 3), dtype=np.float32),
+        'keyword_index': {},
+        '_edge_i': np.empty(0, dtype=np.intp),
+        '_edge_j': np.empty(0, dtype=np.intp),
+        '_edge_sim': np.empty(0),
+        '_keyword_edge_papers': np.empty(0, dtype=np.intp),
+        '_keyword_edge_keywords': np.empty(0, dtype=np.intp),
+        '_keyword_edge_scores': np.empty(0)
     }
 
 def build_paper_detail_network(paper: Dict) -> Dict:
@@ -266,42 +335,29 @@ def build_paper_detail_network(paper: Dict) -> Dict:
     n_keywords = len(keywords)
     
     if n_keywords == 0:
+        empty = np.empty(0, dtype=np.float32)
+        empty.flags.writeable = False
         return {
-            'edge_x': [], 'edge_y': [], 'edge_z': [],
-            'node_x': [], 'node_y': [], 'node_z': [],
-            'node_sizes': [], 'node_colors': [], 'node_labels': [], 'node_hover': []
+            'edge_x': empty, 'edge_y': empty, 'edge_z': empty,
+            'node_x': empty, 'node_y': empty, 'node_z': empty,
+            'node_sizes': empty, 'node_colors': empty, 'node_labels': [], 'node_hover': []
         }
     
-    positions = []
-    golden_angle = np.pi * (3.0 - np.sqrt(5.0))
+    positions = _sphere_positions(n_keywords, 1.0)
     
-    for i in range(n_keywords):
-        y = 1 - (i / float(n_keywords - 1 if n_keywords > 1 else 1)) * 2
-        radius = np.sqrt(1 - y * y)
-        theta = golden_angle * i
-        
-        x = np.cos(theta) * radius
-        z = np.sin(theta) * radius
-        
-        positions.append((x, y, z))
-    
-    # エッジデータ（近いキーワード同士を接続）
-    edge_x, edge_y, edge_z = [], [], []
-    for i in range(n_keywords):
-        for j in range(i + 1, min(i + 3, n_keywords)):
-            x0, y0, z0 = positions[i]
-            x1, y1, z1 = positions[j]
-            edge_x.extend([x0, x1, None])
-            edge_y.extend([y0, y1, None])
-            edge_z.extend([z0, z1, None])
+    # エッジデータ（近いキーワード同士を接続：i→i+1 と i→i+2）
+    src = np.concatenate([np.arange(n_keywords - 1), np.arange(n_keywords - 2)])
+    dst = np.concatenate([np.arange(1, n_keywords), np.arange(2, n_keywords)])
+    
+    # 元の順序（始点ごとに i+1, i+2 の順）に並べ替える
+    order = np.lexsort((dst, src))
+    edge_x, edge_y, edge_z = _edge_coordinates(positions[src[order]], positions[dst[order]])
     
     # ノードデータ
-    node_x = [pos[0] for pos in positions]
-    node_y = [pos[1] for pos in positions]
-    node_z = [pos[2] for pos in positions]
+    node_x, node_y, node_z = _axis_arrays(positions)
     node_labels = [kw for kw, _ in keywords]
-    node_sizes = [10 + score * 20 for _, score in keywords]
-    node_colors = [score for _, score in keywords]
+    node_colors = np.array([score for _, score in keywords], dtype=float)
+    node_sizes = 10 + node_colors * 20
     node_hover = [f"<b>{kw}</b><br>スコア: {score:.3f}" for kw, score in keywords]
     
     return {
@@ -1,28 +1,66 @@
-import io
-from typing import BinaryIO
-import PyPDF2
+import re
+from typing import BinaryIO, List, Sequence
+import pymupdf
 
-def extract_text_from_pdf(file: BinaryIO) -> str:
+# キーワードの網羅性はこの程度の文字数で頭打ちになるため、それ以降は解析しない
+MAX_TEXT_CHARS = 200_000
+
+_WS = re.compile(r'\s+')
+
+def extract_text_from_pdf(file: BinaryIO, max_chars: int = MAX_TEXT_CHARS) -> str:
     """
     PDFファイルからテキストを抽出
     
     Args:
         file: アップロードされたPDFファイル
+        max_chars: 抽出する最大文字数
+        
+    Returns:
+        抽出されたテキスト
+    """
+    return extract_text_from_bytes(file.read(), max_chars)
+
+def extract_text_from_bytes(data: bytes, max_chars: int = MAX_TEXT_CHARS) -> str:
+    """
+    PDFのバイト列からテキストを抽出
+    
+    Args:
+        data: PDFファイルの内容
+        max_chars: 抽出する最大文字数（到達した時点で残りのページは読まない）
         
     Returns:
         抽出されたテキスト
     """
     try:
-        pdf_reader = PyPDF2.PdfReader(io.BytesIO(file.read()))
-        text = ""
+        parts = []
+        n_chars = 0
         
-        # 全ページからテキストを抽出
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
+        # 解析処理はMuPDF（C実装）側で行う
+        with pymupdf.open(stream=data, filetype='pdf') as doc:
+            for page in doc:
+                page_text = page.get_text('text')
+                parts.append(page_text)
+                n_chars += len(page_text)
+                if n_chars >= max_chars:
+                    break
         
         # 空白の正規化
-        text = " ".join(text.split())
+        text = _WS.sub(" ", "\n".join(parts)).strip()
         
-        return text
+        return text[:max_chars]
     except Exception as e:
         return f"Error extracting text: {str(e)}"
+
+def extract_texts_from_pdfs(datas: Sequence[bytes], max_chars: int = MAX_TEXT_CHARS) -> List[str]:
+    """
+    複数のPDFからテキストを抽出
+    
+    Args:
+        datas: PDFファイルの内容のリスト
+        max_chars: 1ファイルあたりに抽出する最大文字数
+        
+    Returns:
+        入力と同じ順序の抽出テキストのリスト
+    """
+    # アップロードは最大10件で1件あたりの解析も短いため、プロセスプールの起動コストに見合わず逐次処理する
+    return [extract_text_from_bytes(data, max_chars) for data in datas]